@@ -1,10 +1,14 @@
+import functools
 import os
+import re
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date
-from typing import Optional, List, Dict, Tuple
+from typing import Optional, List, Dict, Iterator, Tuple
 
-import requests
+import httpx
 
 
 # ==========
@@ -14,7 +18,8 @@ SHOPIFY_SHOP = os.getenv("SHOPIFY_SHOP", "")         # example: "xxx.myshopify.c
 SHOPIFY_TOKEN = os.getenv("SHOPIFY_TOKEN", "")       # Admin API access token
 API_VERSION = os.getenv("SHOPIFY_API_VERSION", "2026-01")
 TIMEOUT = 30
-SLEEP_SEC = 0.12
+EXPECTED_QUERY_COST = 50  # cost budgeted before each call
+BATCH_SIZE = 24  # metafieldsSet accepts up to 25 metafields per call
 
 NAMESPACE = "custom"
 
@@ -34,6 +39,44 @@ PROMOS = [
 ]
 
 
+# ==========
+# GraphQL documents (built once at import)
+# ==========
+Q_COLLECTION_BY_HANDLE = """
+query($handle: String!) {
+  collectionByHandle(handle: $handle) { id title }
+}
+"""
+
+Q_FIND_COLLECTION = """
+query($q: String!) {
+  collections(first: 20, query: $q) {
+    nodes { id title }
+  }
+}
+"""
+
+Q_LIST_COLLECTION_PRODUCTS = """
+query($id: ID!, $cursor: String) {
+  collection(id: $id) {
+    products(first: 250, after: $cursor) {
+      pageInfo { hasNextPage endCursor }
+      nodes { id }
+    }
+  }
+}
+"""
+
+M_METAFIELDS_SET = """
+mutation($m: [MetafieldsSetInput!]!) {
+  metafieldsSet(metafields: $m) {
+    metafields { id namespace key }
+    userErrors { field message }
+  }
+}
+"""
+
+
 # ==========
 # Helpers
 # ==========
@@ -41,9 +84,16 @@ def require_env():
     if not SHOPIFY_SHOP or not SHOPIFY_TOKEN:
         raise ValueError("Missing SHOPIFY_SHOP or SHOPIFY_TOKEN. Set them as environment variables first.")
 
+@functools.lru_cache(maxsize=4096)
 def norm(s: str) -> str:
     return " ".join((s or "").strip().lower().split())
 
+_MMDD_RE = re.compile(r"^(\d{1,2})[./-](\d{1,2})$")
+_ISO10_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+def handle_of(title: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "-", (title or "").lower()).strip("-")
+
 def parse_mm_dd(s: str, default_year: Optional[int] = None) -> str:
     """
     Accepts:
@@ -58,20 +108,63 @@ def parse_mm_dd(s: str, default_year: Optional[int] = None) -> str:
         raise ValueError("Empty date")
 
     # already ISO
-    if len(s) == 10 and s[4] == "-" and s[7] == "-":
+    if _ISO10_RE.match(s):
         return s
 
     year = default_year or datetime.now().year
-    for sep in [".", "/", "-"]:
-        if sep in s:
-            parts = s.split(sep)
-            if len(parts) == 2:
-                m = int(parts[0])
-                d = int(parts[1])
-                return date(year, m, d).isoformat()
+    md = _MMDD_RE.match(s)
+    if md:
+        return date(year, int(md[1]), int(md[2])).isoformat()
 
     raise ValueError(f"Unrecognized date format: {s}")
 
+_CLIENT: Optional[httpx.Client] = None
+
+def get_client() -> httpx.Client:
+    # Created lazily; one HTTP/2 connection is reused across every graphql() call
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = httpx.Client(
+            http2=True,
+            limits=httpx.Limits(max_connections=1, max_keepalive_connections=1),
+            timeout=TIMEOUT,
+            headers={
+                "X-Shopify-Access-Token": SHOPIFY_TOKEN,
+                "Content-Type": "application/json",
+            },
+        )
+    return _CLIENT
+
+# Shopify cost bucket, refreshed from extensions.cost.throttleStatus after every call
+_THROTTLE_LOCK = threading.Lock()
+_available: Optional[float] = None
+_max_available = 1000.0
+_restore_rate = 50.0
+_throttle_at = 0.0
+
+def _maybe_wait(next_cost: float = EXPECTED_QUERY_COST) -> None:
+    global _available, _throttle_at
+    with _THROTTLE_LOCK:
+        if _available is None:
+            return
+        now = time.monotonic()
+        available = min(_max_available, _available + (now - _throttle_at) * _restore_rate)
+        wait = max(0.0, (next_cost - available) / _restore_rate)
+        _available = available - next_cost
+        _throttle_at = now
+    if wait:
+        time.sleep(wait)
+
+def _record_throttle(data: dict) -> None:
+    global _available, _max_available, _restore_rate, _throttle_at
+    status = (data.get("extensions") or {}).get("cost", {}).get("throttleStatus") or {}
+    if "currentlyAvailable" in status:
+        with _THROTTLE_LOCK:
+            _available = float(status["currentlyAvailable"])
+            _max_available = float(status.get("maximumAvailable") or _max_available)
+            _restore_rate = float(status.get("restoreRate") or _restore_rate)
+            _throttle_at = time.monotonic()
+
 def graphql(query: str, variables: Optional[dict] = None) -> dict:
     # Allow SHOPIFY_SHOP to be either 'example.myshopify.com' or
     # a full URL like 'https://example.myshopify.com'. Normalize it.
@@ -81,81 +174,67 @@ def graphql(query: str, variables: Optional[dict] = None) -> dict:
     else:
         base = f"https://{base}"
     url = f"{base}/admin/api/{API_VERSION}/graphql.json"
-    headers = {
-        "X-Shopify-Access-Token": SHOPIFY_TOKEN,
-        "Content-Type": "application/json",
-    }
-    resp = requests.post(url, headers=headers, json={"query": query, "variables": variables or {}}, timeout=TIMEOUT)
+    _maybe_wait()
+    resp = get_client().post(url, json={"query": query, "variables": variables or {}})
     resp.raise_for_status()
     data = resp.json()
+    _record_throttle(data)
     if data.get("errors"):
         raise RuntimeError(data["errors"])
     return data
 
+@functools.lru_cache(maxsize=512)
 def find_collection_by_title_exact(title: str) -> Optional[Tuple[str, str]]:
-    q = """
-    query($q: String!) {
-      collections(first: 20, query: $q) {
-        nodes { id title }
-      }
-    }
-    """
     target = norm(title)
 
+    # try handle first (cheapest lookup)
+    handle = handle_of(title)
+    if handle:
+        c = graphql(Q_COLLECTION_BY_HANDLE, {"handle": handle})["data"]["collectionByHandle"]
+        if c and norm(c["title"]) == target:
+            return c["id"], c["title"]
+
     # try exact search
-    data = graphql(q, {"q": f'title:"{title}"'})
-    for n in data["data"]["collections"]["nodes"]:
+    data = graphql(Q_FIND_COLLECTION, {"q": f'title:"{title}"'})
+    nodes = data["data"]["collections"]["nodes"]
+    for n in nodes:
         if norm(n["title"]) == target:
             return n["id"], n["title"]
 
-    # fallback
-    data2 = graphql(q, {"q": f"title:{title}"})
+    # fallback (only useful when the exact search returned nothing)
+    if nodes:
+        return None
+    data2 = graphql(Q_FIND_COLLECTION, {"q": f"title:{title}"})
     for n in data2["data"]["collections"]["nodes"]:
         if norm(n["title"]) == target:
             return n["id"], n["title"]
 
     return None
 
-def list_product_ids_in_collection(collection_id: str) -> List[str]:
-    ids: List[str] = []
-    cursor = None
-    has_next = True
-
-    q = """
-    query($id: ID!, $cursor: String) {
-      collection(id: $id) {
-        products(first: 250, after: $cursor) {
-          pageInfo { hasNextPage endCursor }
-          nodes { id }
-        }
-      }
-    }
-    """
-    while has_next:
-        data = graphql(q, {"id": collection_id, "cursor": cursor})
-        conn = data["data"]["collection"]["products"]
-        ids.extend([n["id"] for n in conn["nodes"]])
-        has_next = conn["pageInfo"]["hasNextPage"]
-        cursor = conn["pageInfo"]["endCursor"]
+def iter_product_ids_in_collection(collection_id: str) -> Iterator[str]:
+    # Yields page by page; the next page is fetched in the background while the caller works
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        fut = ex.submit(graphql, Q_LIST_COLLECTION_PRODUCTS, {"id": collection_id, "cursor": None})
+        while fut is not None:
+            conn = fut.result()["data"]["collection"]["products"]
+            page_info = conn["pageInfo"]
+            fut = None
+            if page_info["hasNextPage"]:
+                fut = ex.submit(graphql, Q_LIST_COLLECTION_PRODUCTS, {"id": collection_id, "cursor": page_info["endCursor"]})
+            for n in conn["nodes"]:
+                yield n["id"]
 
-    return ids
+def list_product_ids_in_collection(collection_id: str) -> List[str]:
+    return list(iter_product_ids_in_collection(collection_id))
 
 def metafields_set(metafields: List[dict]) -> None:
-    m = """
-    mutation($m: [MetafieldsSetInput!]!) {
-      metafieldsSet(metafields: $m) {
-        metafields { id namespace key }
-        userErrors { field message }
-      }
-    }
-    """
     # Debug: print payload summary
     try:
         print(f"    Writing metafields: {[(mf['ownerId'], mf['namespace'], mf['key']) for mf in metafields]}")
     except Exception:
         pass
 
-    data = graphql(m, {"m": metafields})
+    data = graphql(M_METAFIELDS_SET, {"m": metafields})
     # Debug: show full response for investigation
     print(f"    GraphQL response: {data}")
 
@@ -189,6 +268,15 @@ def build_metafields(product_id: str, promo_type: str, start_iso: str, end_iso:
         },
     ]
 
+def flush_batch(batch: List[dict], dry_run: bool) -> None:
+    if not batch:
+        return
+    products = len({mf["ownerId"] for mf in batch})
+    if dry_run:
+        print(f"  DRY_RUN batch: {len(batch)} metafields for {products} products")
+    else:
+        metafields_set(batch)
+
 
 # ==========
 # Main
@@ -203,6 +291,8 @@ def main():
     print(f"Dry run: {dry_run}")
     print("")
 
+    batch: List[dict] = []
+
     for p in PROMOS:
         title = p["collection"]
         promo_type = p["type"]
@@ -219,21 +309,23 @@ def main():
         col_id, col_title = col
         print(f"  Matched collection: {col_title}")
 
-        product_ids = list_product_ids_in_collection(col_id)
-        print(f"  Products: {len(product_ids)}")
-
-        for pid in product_ids:
+        count = 0
+        for pid in iter_product_ids_in_collection(col_id):
+            count += 1
             payload = build_metafields(pid, promo_type, start_iso, end_iso)
 
             if dry_run:
                 print(f"    DRY_RUN {pid}: {[(x['key'], x['value']) for x in payload]}")
-            else:
-                metafields_set(payload)
 
-            time.sleep(SLEEP_SEC)
+            batch.extend(payload)
+            if len(batch) >= BATCH_SIZE:
+                flush_batch(batch, dry_run)
+                batch = []
 
+        print(f"  Products: {count}")
         print("")
 
+    flush_batch(batch, dry_run)
     print("Done.")
 
 if __name__ == "__main__":
@@ -1,11 +1,17 @@
+import collections
+import functools
+import json
 import os
+import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from datetime import datetime, date, timedelta
-from typing import Optional, Dict, List, Tuple
+from datetime import datetime, date
+from typing import Callable, Optional, Dict, Iterable, Iterator, List, Set, Tuple
 
+import httpx
 import pyodbc
-import requests
 
 # Optional: load .env automatically if python-dotenv installed
 try:
@@ -63,7 +69,24 @@ class Config:
     # Behavior
     DRY_RUN = os.getenv("DRY_RUN", "1").strip().lower() in ("1", "true", "yes")
     DB_ONLY = os.getenv("DB_ONLY", "0").strip().lower() in ("1", "true", "yes")
-    SLEEP_BETWEEN_CALLS = float(os.getenv("SLEEP_BETWEEN_CALLS", "0.12"))
+    VENDOR_WORKERS = int(os.getenv("VENDOR_WORKERS", "6"))
+    COLLECTION_WORKERS = int(os.getenv("COLLECTION_WORKERS", "8"))
+
+    # Query cost budgeted before each call; throttling follows Shopify's throttleStatus
+    EXPECTED_QUERY_COST = int(os.getenv("EXPECTED_QUERY_COST", "50"))
+    # Retries for GraphQL THROTTLED errors and read timeouts (HTTP 429/5xx are retried by RetryTransport)
+    GRAPHQL_RETRIES = int(os.getenv("GRAPHQL_RETRIES", "4"))
+
+    # metafieldsSet accepts at most 25 metafields per call; keep one slot of headroom
+    METAFIELDS_PER_CALL = 24
+    DELETE_BATCH_SIZE = 25
+    # Mutations per GraphQL document (metafieldsSet + metafieldDelete aliases); kept conservative
+    MAX_MUTATIONS_PER_DOC = 4
+    BULK_POLL_SEC = float(os.getenv("BULK_POLL_SEC", "2"))
+    BULK_MAX_WAIT_SEC = float(os.getenv("BULK_MAX_WAIT_SEC", "120"))   # then cancel and page instead
+
+    # product_id -> metafield keys known to exist after the last run (skips needless delete lookups)
+    STATE_FILE = os.getenv("STATE_FILE", "state.json").strip()
 
     # Metafields
     MF_NAMESPACE = "custom"
@@ -73,15 +96,123 @@ class Config:
     MF_PI_END = "promo_pi_end_date"
 
 
+# =========================
+# GraphQL documents
+# =========================
+# Built once at import so every call sends the identical query text
+Q_COLLECTION_BY_HANDLE = """
+query($handle: String!) {
+  collectionByHandle(handle: $handle) { id title }
+}
+"""
+
+
+Q_FIND_COLLECTION = """
+query($q: String!) {
+  collections(first: 20, query: $q) {
+    nodes { id title }
+  }
+}
+"""
+
+
+Q_LIST_COLLECTION_PRODUCTS = """
+query($id: ID!, $cursor: String) {
+  collection(id: $id) {
+    products(first: 250, after: $cursor) {
+      pageInfo { hasNextPage endCursor }
+      nodes { id }
+    }
+  }
+}
+"""
+
+
+M_BULK_OPERATION_RUN_QUERY = """
+mutation($q: String!) {
+  bulkOperationRunQuery(query: $q) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}
+"""
+
+
+Q_BULK_OPERATION = """
+query($id: ID!) {
+  node(id: $id) {
+    ... on BulkOperation { id status errorCode url }
+  }
+}
+"""
+
+
+M_BULK_OPERATION_CANCEL = """
+mutation($id: ID!) {
+  bulkOperationCancel(id: $id) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}
+"""
+
+
+Q_LIST_VENDOR_PRODUCTS = """
+query($q: String!, $cursor: String) {
+  products(first: 250, after: $cursor, query: $q) {
+    pageInfo { hasNextPage endCursor }
+    nodes { id }
+  }
+}
+"""
+
+
+@functools.lru_cache(maxsize=64)
+def m_metafield_changes(with_set: bool, n_deletes: int) -> str:
+    """
+    One document running an optional metafieldsSet (alias s, variable $set) plus
+    n_deletes metafieldDelete mutations (aliases d0.., variables $d0..).
+    """
+    var_defs = (["$set: [MetafieldsSetInput!]!"] if with_set else []) + [f"$d{i}: ID!" for i in range(n_deletes)]
+    fields = (["  s: metafieldsSet(metafields: $set) { metafields { id } userErrors { field message } }"]
+              if with_set else [])
+    fields += [
+        f"  d{i}: metafieldDelete(input: {{id: $d{i}}}) {{ deletedId userErrors {{ field message }} }}"
+        for i in range(n_deletes)
+    ]
+    return f"mutation({', '.join(var_defs)}) {{\n" + "\n".join(fields) + "\n}\n"
+
+
+@functools.lru_cache(maxsize=64)
+def q_metafield_ids(n: int) -> str:
+    """Aliased lookup for n products (p0..p{n-1}); cached so each batch size is built once."""
+    var_defs = "".join(f", $id{i}: ID!" for i in range(n))
+    fields = "\n".join(
+        f"  p{i}: product(id: $id{i}) {{ metafields(identifiers: $idents) {{ id key namespace }} }}"
+        for i in range(n)
+    )
+    return f"query($idents: [HasMetafieldsIdentifier!]!{var_defs}) {{\n{fields}\n}}\n"
+
+
 def require_env():
     if not Config.SHOPIFY_SHOP or not Config.SHOPIFY_TOKEN:
         raise ValueError("Missing SHOPIFY_SHOP or SHOPIFY_TOKEN. Put them in .env or environment variables.")
 
 
+# YYYY-MM-DD with optional " HH:MM:SS[.ffffff]" / "THH:MM:SS[.ffffff]" (replaces per-row strptime)
+_ISO_RE = re.compile(r"^(\d{4})-(\d{2})-(\d{2})(?:[ T](\d{2}):(\d{2}):(\d{2})(?:\.\d+)?)?$")
+
+
+@functools.lru_cache(maxsize=4096)
 def normalize(s: str) -> str:
     return " ".join((s or "").strip().lower().split())
 
 
+def handle_of(title: str) -> str:
+    """Shopify's default handle for a title: lowercase, non-alphanumerics collapsed to '-'."""
+    return re.sub(r"[^a-z0-9]+", "-", (title or "").lower()).strip("-")
+
+
 def to_date_only(v) -> Optional[date]:
     if v is None:
         return None
@@ -91,11 +222,12 @@ def to_date_only(v) -> Optional[date]:
         return v
     if isinstance(v, str):
         s = v.strip()
-        for fmt in ("%Y-%m-%d", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M:%S.%f"):
+        m = _ISO_RE.match(s)
+        if m:
             try:
-                return datetime.strptime(s, fmt).date()
+                return date(int(m[1]), int(m[2]), int(m[3]))
             except ValueError:
-                pass
+                return None
         try:
             return datetime.fromisoformat(s.replace("Z", "")).date()
         except Exception:
@@ -107,12 +239,14 @@ def to_date_only(v) -> Optional[date]:
 # Data Models
 # =========================
 @dataclass
-class RetailPromoRow:
-    id: int
+class RetailPromoWindow:
+    """One (Vendor, EntryType) group aggregated in SQL."""
     vendor: str
     entry_type: str
-    start_date: date
-    end_date: Optional[date]
+    real_start: date
+    real_end: Optional[date]     # None if no row in the group has an end date
+    display_start: date
+    display_end: date
 
 
 @dataclass
@@ -145,11 +279,23 @@ class DatabaseConnection:
             f"PWD={Config.DB_PASSWORD}"
         )
         self.cursor = self.conn.cursor()
+        self.cursor.arraysize = 5000
 
-    def query(self, sql: str) -> List[Dict]:
-        self.cursor.execute(sql)
-        cols = [c[0] for c in self.cursor.description]
-        return [dict(zip(cols, row)) for row in self.cursor.fetchall()]
+    def iter_query(self, sql: str, params: tuple = ()) -> Iterator[tuple]:
+        """
+        Streams rows in arraysize chunks instead of materializing the whole result set.
+        Rows are namedtuples built once per query from the column names (row.Vendor, ...).
+        `params` are bound to the `?` placeholders, so the SQL text (and its cached plan)
+        stays the same between runs.
+        """
+        self.cursor.execute(sql, params)
+        Row = collections.namedtuple("Row", [c[0] for c in self.cursor.description])
+        while True:
+            rows = self.cursor.fetchmany(self.cursor.arraysize)
+            if not rows:
+                return
+            for row in rows:
+                yield Row._make(row)
 
     def close(self):
         try:
@@ -160,7 +306,8 @@ class DatabaseConnection:
 
 class RetailPromotionsReader:
     """
-    Reads promotions that should exist today based on display windows.
+    Reads promotions that should exist today based on display windows,
+    already aggregated per (Vendor, EntryType) by SQL Server.
 
     Sale window:
       show_from = StartD - X
@@ -169,294 +316,719 @@ class RetailPromotionsReader:
     Price Increase window:
       show_from = StartD - Y
       show_to   = EndD if exists else StartD + Z
+
+    Per group: real start = MIN(StartD), real end = MAX(EndD) (NULL when every
+    end is missing), display window = MIN(show_from) -> MAX(show_to).
     """
     def __init__(self, db: DatabaseConnection):
         self.db = db
 
-    def fetch_active_today(self, x: int, y: int, z: int) -> List[RetailPromoRow]:
-        sql = f"""
-        DECLARE @X INT = {x};
-        DECLARE @Y INT = {y};
-        DECLARE @Z INT = {z};
-
+    def fetch_active_today(self, x: int, y: int, z: int) -> Iterator[RetailPromoWindow]:
+        # Bound parameters, in order: X, Y, Z
+        sql = """
         WITH t AS (
             SELECT
-                ID,
-                Vendor,
-                EntryType,
+                LTRIM(RTRIM(Vendor))    AS Vendor,
+                LTRIM(RTRIM(EntryType)) AS EntryType,
                 TRY_CONVERT(date, Date_of_Start) AS StartD,
                 TRY_CONVERT(date, Date_of_End)   AS EndD
             FROM Ecomm_DB_PROD.dbo.SM_Retail_Sales
+        ),
+        w AS (
+            SELECT
+                Vendor,
+                EntryType,
+                StartD,
+                EndD,
+                CASE WHEN EntryType = 'Sale'
+                     THEN DATEADD(day, -?, StartD)
+                     ELSE DATEADD(day, -?, StartD)
+                END AS ShowFrom,
+                CASE WHEN EntryType = 'Sale'
+                     THEN EndD
+                     ELSE COALESCE(EndD, DATEADD(day, ?, StartD))
+                END AS ShowTo
+            FROM t
+            WHERE
+                Vendor <> ''
+                AND StartD IS NOT NULL
+                AND (
+                    (EntryType = 'Sale' AND EndD IS NOT NULL)
+                    OR EntryType = 'Price Increase'
+                )
         )
         SELECT
-            ID,
             Vendor,
             EntryType,
-            StartD AS Date_of_Start,
-            EndD   AS Date_of_End
-        FROM t
+            MIN(StartD)   AS RealStart,
+            MAX(EndD)     AS RealEnd,
+            MIN(ShowFrom) AS DisplayStart,
+            MAX(ShowTo)   AS DisplayEnd
+        FROM w
         WHERE
-        (
-            LTRIM(RTRIM(EntryType)) = 'Sale'
-            AND StartD IS NOT NULL
-            AND EndD IS NOT NULL
-            AND DATEADD(day, -@X, StartD) <= CAST(GETDATE() AS date)
-            AND EndD >= CAST(GETDATE() AS date)
-        )
-        OR
-        (
-            LTRIM(RTRIM(EntryType)) = 'Price Increase'
-            AND StartD IS NOT NULL
-            AND DATEADD(day, -@Y, StartD) <= CAST(GETDATE() AS date)
-            AND COALESCE(EndD, DATEADD(day, @Z, StartD)) >= CAST(GETDATE() AS date)
-        );
+            ShowFrom <= CAST(GETDATE() AS date)
+            AND ShowTo >= CAST(GETDATE() AS date)
+        GROUP BY Vendor, EntryType;
         """
-        raw = self.db.query(sql)
-        print("DEBUG fetch_active_today raw rows =", len(raw))
-
-        rows: List[RetailPromoRow] = []
-        for r in raw:
-            vendor = (r.get("Vendor") or "").strip()
-            entry_type = (r.get("EntryType") or "").strip()
-            s = to_date_only(r.get("Date_of_Start"))
-            e = to_date_only(r.get("Date_of_End"))
-
-            if not vendor or not entry_type or not s:
-                continue
-
-            rows.append(RetailPromoRow(
-                id=int(r["ID"]),
-                vendor=vendor,
-                entry_type=entry_type,
-                start_date=s,
-                end_date=e
-            ))
-        return rows
+        for r in self.db.iter_query(sql, (x, y, z)):
+            yield RetailPromoWindow(
+                vendor=r.Vendor,
+                entry_type=r.EntryType,
+                real_start=to_date_only(r.RealStart),
+                real_end=to_date_only(r.RealEnd),
+                display_start=to_date_only(r.DisplayStart),
+                display_end=to_date_only(r.DisplayEnd),
+            )
 
 
 # =========================
 # Aggregation
 # =========================
-def compute_display_window(row: RetailPromoRow, x: int, y: int, z: int) -> Tuple[date, date]:
-    t = normalize(row.entry_type)
-
-    if t == "sale":
-        # appear X days early, disappear at real end
-        return (row.start_date - timedelta(days=x)), (row.end_date or row.start_date)
-
-    if t == "price increase":
-        # appear Y days early, disappear at real end, else start + Z
-        end_display = row.end_date if row.end_date else (row.start_date + timedelta(days=z))
-        return (row.start_date - timedelta(days=y)), end_display
-
-    return row.start_date, row.start_date
-
-
-def aggregate_by_vendor(rows: List[RetailPromoRow], x: int, y: int, z: int) -> List[VendorPlan]:
+def build_vendor_plans(rows: Iterable[RetailPromoWindow]) -> List[VendorPlan]:
+    """Folds the SQL-aggregated (vendor, entry type) rows into one VendorPlan per vendor."""
     by_vendor: Dict[str, VendorPlan] = {}
 
     for r in rows:
-        v = r.vendor
-        w = by_vendor.get(v) or VendorPlan(vendor=v)
+        w = by_vendor.setdefault(r.vendor, VendorPlan(vendor=r.vendor))
         t = normalize(r.entry_type)
 
-        d_start, d_end = compute_display_window(r, x, y, z)
-
         if t == "sale":
-            w.sale_display_start = d_start if w.sale_display_start is None else min(w.sale_display_start, d_start)
-            w.sale_display_end = d_end if w.sale_display_end is None else max(w.sale_display_end, d_end)
-
-            w.sale_real_start = r.start_date if w.sale_real_start is None else min(w.sale_real_start, r.start_date)
-            real_end = r.end_date or r.start_date
-            w.sale_real_end = real_end if w.sale_real_end is None else max(w.sale_real_end, real_end)
+            w.sale_display_start, w.sale_display_end = r.display_start, r.display_end
+            w.sale_real_start, w.sale_real_end = r.real_start, r.real_end
 
         elif t == "price increase":
-            w.pi_display_start = d_start if w.pi_display_start is None else min(w.pi_display_start, d_start)
-            w.pi_display_end = d_end if w.pi_display_end is None else max(w.pi_display_end, d_end)
+            w.pi_display_start, w.pi_display_end = r.display_start, r.display_end
+            # IMPORTANT: real_end stays None if DB end is missing, so no end date is forced into Shopify.
+            # Liquid can display "Starts on" when pi_end is missing.
+            w.pi_real_start, w.pi_real_end = r.real_start, r.real_end
 
-            w.pi_real_start = r.start_date if w.pi_real_start is None else min(w.pi_real_start, r.start_date)
+    return list(by_vendor.values())
 
-            # IMPORTANT: do NOT force an end date into Shopify if DB end is missing
-            # Liquid can display "Starts on" when pi_end is missing.
-            if r.end_date is not None:
-                w.pi_real_end = r.end_date if w.pi_real_end is None else max(w.pi_real_end, r.end_date)
 
-        by_vendor[v] = w
+def _min_date(a: Optional[date], b: Optional[date]) -> Optional[date]:
+    return b if a is None else a if b is None else min(a, b)
+
+
+def _max_date(a: Optional[date], b: Optional[date]) -> Optional[date]:
+    return b if a is None else a if b is None else max(a, b)
 
-    return list(by_vendor.values())
+
+def merge_plans(a: VendorPlan, b: VendorPlan) -> VendorPlan:
+    """Combines two plans for a product listed under both vendors: earliest start, latest end."""
+    return VendorPlan(
+        vendor=f"{a.vendor} + {b.vendor}",
+        sale_display_start=_min_date(a.sale_display_start, b.sale_display_start),
+        sale_display_end=_max_date(a.sale_display_end, b.sale_display_end),
+        pi_display_start=_min_date(a.pi_display_start, b.pi_display_start),
+        pi_display_end=_max_date(a.pi_display_end, b.pi_display_end),
+        sale_real_start=_min_date(a.sale_real_start, b.sale_real_start),
+        sale_real_end=_max_date(a.sale_real_end, b.sale_real_end),
+        pi_real_start=_min_date(a.pi_real_start, b.pi_real_start),
+        # Stays None only if neither vendor has a PI end date
+        pi_real_end=_max_date(a.pi_real_end, b.pi_real_end),
+    )
 
 
 # =========================
 # Shopify GraphQL Client
 # =========================
+class RetryTransport(httpx.HTTPTransport):
+    """
+    httpx transport that retries 429/5xx responses with exponential backoff,
+    honoring Retry-After (httpx's counterpart of a urllib3 Retry on an HTTPAdapter).
+    Connection errors are retried by the underlying transport.
+    """
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, total: int = 4, backoff_factor: float = 1.0, **kwargs):
+        super().__init__(retries=total, **kwargs)
+        self.total = total
+        self.backoff_factor = backoff_factor
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        attempt = 0
+        while True:
+            response = super().handle_request(request)
+            if response.status_code not in self.RETRY_STATUSES or attempt >= self.total:
+                return response
+
+            delay = self.backoff_factor * (2 ** attempt)
+            retry_after = response.headers.get("Retry-After")
+            if retry_after:
+                try:
+                    delay = float(retry_after)
+                except ValueError:
+                    pass
+            response.close()
+            time.sleep(delay)
+            attempt += 1
+
+
 class ShopifyClient:
     def __init__(self):
         self.endpoint = f"https://{Config.SHOPIFY_SHOP}/admin/api/{Config.SHOPIFY_API_VERSION}/graphql.json"
 
-    def graphql(self, query: str, variables: Optional[dict] = None, retries: int = 4) -> dict:
-        headers = {
-            "X-Shopify-Access-Token": Config.SHOPIFY_TOKEN,
-            "Content-Type": "application/json",
-        }
+        # One HTTP/2 connection for every call: worker threads multiplex their requests
+        # as streams over a single warm TLS session to the shop
+        self._client = httpx.Client(
+            transport=RetryTransport(
+                total=4,
+                backoff_factor=1.0,
+                http2=True,
+                limits=httpx.Limits(max_connections=1, max_keepalive_connections=1),
+            ),
+            timeout=Config.REQUEST_TIMEOUT,
+            headers={
+                "X-Shopify-Access-Token": Config.SHOPIFY_TOKEN,
+                "Content-Type": "application/json",
+            },
+        )
+
+        # Mirror of Shopify's cost bucket, refreshed from extensions.cost.throttleStatus.
+        # Shared by all worker threads because the limit is per shop.
+        self._throttle_lock = threading.Lock()
+        self._available: Optional[float] = None   # unknown until the first response
+        self._max_available = 1000.0
+        self._restore_rate = 50.0
+        self._throttle_at = time.monotonic()
+        # query text -> requestedQueryCost last reported by Shopify (a products page costs far more than 50)
+        self._query_costs: Dict[str, float] = {}
+
+        # title -> (collection_id, title) or None, for the process lifetime
+        self._collection_cache: Dict[str, Optional[Tuple[str, str]]] = {}
+
+        # collection_id -> product IDs from a finished bulk operation (process lifetime)
+        self._bulk_cache: Dict[str, List[str]] = {}
+        # The shop runs one bulk query at a time; only one worker thread may own it
+        self._bulk_lock = threading.Lock()
+
+    def _maybe_wait(self, next_cost: float = Config.EXPECTED_QUERY_COST) -> None:
+        """Sleep only if the bucket cannot cover next_cost; reserves the cost for this thread."""
+        with self._throttle_lock:
+            if self._available is None:
+                return
+            now = time.monotonic()
+            available = min(self._max_available, self._available + (now - self._throttle_at) * self._restore_rate)
+            wait = max(0.0, (next_cost - available) / self._restore_rate)
+            self._available = available - next_cost
+            self._throttle_at = now
+        if wait:
+            time.sleep(wait)
+
+    def _record_throttle(self, query: str, data: dict) -> None:
+        cost = (data.get("extensions") or {}).get("cost") or {}
+        if cost.get("requestedQueryCost") is not None:
+            self._query_costs[query] = float(cost["requestedQueryCost"])
+
+        status = cost.get("throttleStatus") or {}
+        if "currentlyAvailable" not in status:
+            return
+        with self._throttle_lock:
+            self._available = float(status["currentlyAvailable"])
+            self._max_available = float(status.get("maximumAvailable") or self._max_available)
+            self._restore_rate = float(status.get("restoreRate") or self._restore_rate)
+            self._throttle_at = time.monotonic()
+
+    def _throttle_delay(self, cost: float, attempt: int) -> float:
+        """Time until the bucket refills enough for `cost`; plain backoff if Shopify sent no status."""
+        with self._throttle_lock:
+            if self._available is None:
+                return 1.0 + attempt
+            return max(0.5, (cost - self._available) / self._restore_rate)
+
+    def graphql(self, query: str, variables: Optional[dict] = None) -> dict:
+        # HTTP 429/5xx are retried inside RetryTransport. THROTTLED errors arrive as
+        # HTTP 200 and read timeouts are not covered there, so both are retried here.
         payload = {"query": query, "variables": variables or {}}
 
-        last_err = None
-        for attempt in range(retries):
-            try:
-                resp = requests.post(self.endpoint, headers=headers, json=payload, timeout=Config.REQUEST_TIMEOUT)
+        for attempt in range(Config.GRAPHQL_RETRIES + 1):
+            last_attempt = attempt == Config.GRAPHQL_RETRIES
+            # Budget what this query cost last time (a 250-product page costs far more than the default)
+            self._maybe_wait(self._query_costs.get(query, Config.EXPECTED_QUERY_COST))
 
-                if resp.status_code in (429, 500, 502, 503, 504):
-                    last_err = RuntimeError(f"Temporary Shopify error {resp.status_code}: {resp.text}")
-                    time.sleep(1.2 + attempt * 1.0)
-                    continue
+            try:
+                resp = self._client.post(self.endpoint, json=payload)
+            except httpx.TimeoutException:
+                if last_attempt:
+                    raise
+                time.sleep(1.0 + attempt)
+                continue
 
-                resp.raise_for_status()
-                data = resp.json()
+            resp.raise_for_status()
+            data = resp.json()
+            self._record_throttle(query, data)
 
-                if data.get("errors"):
-                    raise RuntimeError(f"GraphQL errors: {data['errors']}")
+            errors = data.get("errors")
+            if errors:
+                throttled = any((e.get("extensions") or {}).get("code") == "THROTTLED" for e in errors)
+                if throttled and not last_attempt:
+                    cost = self._query_costs.get(query, Config.EXPECTED_QUERY_COST)
+                    time.sleep(self._throttle_delay(cost, attempt))
+                    continue
+                raise RuntimeError(f"GraphQL errors: {errors}")
 
-                return data
-            except Exception as e:
-                last_err = e
-                time.sleep(1.0 + attempt * 1.0)
+            return data
 
-        raise RuntimeError(f"Shopify GraphQL failed after retries: {last_err}")
+        raise RuntimeError("Shopify GraphQL failed after retries")
 
     def find_collection_by_title_exact(self, title: str) -> Optional[Tuple[str, str]]:
-        q = """
-        query($q: String!) {
-          collections(first: 20, query: $q) {
-            nodes { id title }
-          }
-        }
-        """
+        if title in self._collection_cache:
+            return self._collection_cache[title]
+        col = self._find_collection_by_title_exact(title)
+        self._collection_cache[title] = col
+        return col
+
+    def _find_collection_by_title_exact(self, title: str) -> Optional[Tuple[str, str]]:
         target = normalize(title)
 
-        data = self.graphql(q, {"q": f'title:"{title}"'})
-        for n in data["data"]["collections"]["nodes"]:
+        # Cheapest first: direct handle lookup (collections usually keep the default handle)
+        handle = handle_of(title)
+        if handle:
+            c = self.graphql(Q_COLLECTION_BY_HANDLE, {"handle": handle})["data"]["collectionByHandle"]
+            if c and normalize(c.get("title", "")) == target:
+                return c["id"], c["title"]
+
+        data = self.graphql(Q_FIND_COLLECTION, {"q": f'title:"{title}"'})
+        nodes = data["data"]["collections"]["nodes"]
+        for n in nodes:
             if normalize(n.get("title", "")) == target:
                 return n["id"], n["title"]
 
-        data2 = self.graphql(q, {"q": f"title:{title}"})
+        # The unquoted search only adds anything when the quoted one found nothing at all
+        if nodes:
+            return None
+
+        data2 = self.graphql(Q_FIND_COLLECTION, {"q": f"title:{title}"})
         for n in data2["data"]["collections"]["nodes"]:
             if normalize(n.get("title", "")) == target:
                 return n["id"], n["title"]
 
         return None
 
+    def iter_product_ids_in_collection(self, collection_id: str, after: Optional[str] = None) -> Iterator[str]:
+        """
+        Yields product IDs page by page, starting after cursor `after`. The next page
+        is requested in a background thread before the current page is handed to the caller.
+        """
+        with ThreadPoolExecutor(max_workers=1) as ex:
+            fut = ex.submit(self.graphql, Q_LIST_COLLECTION_PRODUCTS, {"id": collection_id, "cursor": after})
+            while fut is not None:
+                conn = fut.result()["data"]["collection"]["products"]
+                page_info = conn["pageInfo"]
+                fut = None
+                if page_info["hasNextPage"]:
+                    fut = ex.submit(self.graphql, Q_LIST_COLLECTION_PRODUCTS, {"id": collection_id, "cursor": page_info["endCursor"]})
+                for n in conn["nodes"]:
+                    yield n["id"]
+
     def list_product_ids_in_collection(self, collection_id: str) -> List[str]:
-        ids: List[str] = []
-        cursor = None
-        has_next = True
+        return list(self.iter_product_ids_in_collection(collection_id))
 
-        q = """
-        query($id: ID!, $cursor: String) {
-          collection(id: $id) {
-            products(first: 250, after: $cursor) {
-              pageInfo { hasNextPage endCursor }
-              nodes { id }
-            }
-          }
-        }
+    def bulk_list_product_ids_in_collection(self, collection_id: str) -> List[str]:
         """
-        while has_next:
-            data = self.graphql(q, {"id": collection_id, "cursor": cursor})
-            conn = data["data"]["collection"]["products"]
-            ids.extend([n["id"] for n in conn["nodes"]])
-            has_next = conn["pageInfo"]["hasNextPage"]
-            cursor = conn["pageInfo"]["endCursor"]
+        Lists a collection's products. Collections that fit in one 250-product page are
+        answered by that page alone; bigger ones use bulkOperationRunQuery (one mutation,
+        a few polls and one JSONL download) when this client's bulk slot is free and this
+        is not a DRY_RUN, and keep paging from the first page otherwise.
+        """
+        if collection_id in self._bulk_cache:
+            return self._bulk_cache[collection_id]
+
+        data = self.graphql(Q_LIST_COLLECTION_PRODUCTS, {"id": collection_id, "cursor": None})
+        conn = data["data"]["collection"]["products"]
+        ids = [n["id"] for n in conn["nodes"]]
+        cursor = conn["pageInfo"]["endCursor"]
+
+        if conn["pageInfo"]["hasNextPage"]:
+            bulk_ids: Optional[List[str]] = None
+            # A dry run must not take the shop's only bulk slot
+            if not Config.DRY_RUN and self._bulk_lock.acquire(blocking=False):
+                try:
+                    bulk_ids = self._run_bulk_product_ids(collection_id)
+                finally:
+                    self._bulk_lock.release()
+
+            if bulk_ids is not None:
+                ids = bulk_ids
+            else:
+                ids.extend(self.iter_product_ids_in_collection(collection_id, after=cursor))
+
+        self._bulk_cache[collection_id] = ids
+        return ids
+
+    def _run_bulk_product_ids(self, collection_id: str) -> Optional[List[str]]:
+        """
+        Runs one bulk query for the collection's products. Returns None (caller pages
+        instead) when the bulk operation cannot start, fails, does not finish within
+        BULK_MAX_WAIT_SEC, or its result file cannot be downloaded.
+        """
+        bulk_q = f'{{ collection(id: "{collection_id}") {{ products {{ edges {{ node {{ id }} }} }} }} }}'
+        data = self.graphql(M_BULK_OPERATION_RUN_QUERY, {"q": bulk_q})
+        res = data["data"]["bulkOperationRunQuery"]
+        errs = res["userErrors"]
+        if errs:
+            if any("already in progress" in (e.get("message") or "") for e in errs):
+                print("  Bulk operation already running. Fallback: paged listing")
+            else:
+                print(f"  bulkOperationRunQuery userErrors: {errs}. Fallback: paged listing")
+            return None
 
+        op_id = res["bulkOperation"]["id"]
+        deadline = time.monotonic() + Config.BULK_MAX_WAIT_SEC
+        while True:
+            op = self.graphql(Q_BULK_OPERATION, {"id": op_id})["data"]["node"]
+            status = op["status"]
+            if status == "COMPLETED":
+                break
+            if status in ("FAILED", "CANCELED", "EXPIRED"):
+                print(f"  Bulk operation {op_id} {status}: {op.get('errorCode')}. Fallback: paged listing")
+                return None
+            if time.monotonic() >= deadline:
+                print(f"  Bulk operation {op_id} still {status} after {Config.BULK_MAX_WAIT_SEC}s. Fallback: paged listing")
+                try:
+                    self.graphql(M_BULK_OPERATION_CANCEL, {"id": op_id})
+                except Exception as e:
+                    print(f"  Bulk cancel failed: {e}")
+                return None
+            time.sleep(Config.BULK_POLL_SEC)
+
+        ids: List[str] = []
+        if op.get("url"):
+            try:
+                # Signed storage URL: plain GET, do NOT send the Shopify token along
+                resp = httpx.get(op["url"], timeout=Config.REQUEST_TIMEOUT)
+                resp.raise_for_status()
+                for line in resp.text.splitlines():
+                    if not line:
+                        continue
+                    node = json.loads(line)
+                    # Product lines carry __parentId; the collection line itself does not
+                    if node.get("__parentId"):
+                        ids.append(node["id"])
+            except (httpx.HTTPError, ValueError) as e:
+                print(f"  Bulk result download failed: {e}. Fallback: paged listing")
+                return None
         return ids
 
     def list_product_ids_by_vendor(self, vendor: str) -> List[str]:
         ids: List[str] = []
         cursor = None
         has_next = True
-        target = normalize(vendor)
-
-        q = """
-        query($q: String!, $cursor: String) {
-          products(first: 250, after: $cursor, query: $q) {
-            pageInfo { hasNextPage endCursor }
-            nodes { id vendor }
-          }
-        }
-        """
-        qstr = f'vendor:"{vendor}"'
+
+        # vendor:"..." is an exact match server-side, so no client-side re-filtering;
+        # escape embedded quotes so the phrase stays intact
+        escaped = vendor.replace("\\", "\\\\").replace('"', '\\"')
+        qstr = f'vendor:"{escaped}"'
 
         while has_next:
-            data = self.graphql(q, {"q": qstr, "cursor": cursor})
+            data = self.graphql(Q_LIST_VENDOR_PRODUCTS, {"q": qstr, "cursor": cursor})
             conn = data["data"]["products"]
-
-            for n in conn["nodes"]:
-                if normalize(n.get("vendor", "")) == target:
-                    ids.append(n["id"])
+            ids.extend(n["id"] for n in conn["nodes"])
 
             has_next = conn["pageInfo"]["hasNextPage"]
             cursor = conn["pageInfo"]["endCursor"]
 
         return ids
 
-    def metafields_set(self, metafields: List[dict]) -> None:
-        m = """
-        mutation($m: [MetafieldsSetInput!]!) {
-          metafieldsSet(metafields: $m) {
-            metafields { id namespace key }
-            userErrors { field message }
-          }
-        }
+    def apply_metafield_changes(self, metafields: List[dict], delete_ids: List[str],
+                                on_applied: Optional[Callable[[bool, List[str]], None]] = None) -> int:
         """
-        data = self.graphql(m, {"m": metafields})
-        errs = data["data"]["metafieldsSet"]["userErrors"]
-        if errs:
-            raise RuntimeError(f"metafieldsSet userErrors: {errs}")
-
-    def get_metafield_ids(self, product_id: str, namespace: str, keys: List[str]) -> Dict[str, Optional[str]]:
-        q = """
-        query($id: ID!, $idents: [HasMetafieldsIdentifier!]!) {
-          product(id: $id) {
-            metafields(identifiers: $idents) {
-              id
-              key
-              namespace
-            }
-          }
-        }
+        Runs the metafieldsSet for `metafields` and the metafieldDelete for every id in
+        `delete_ids` using as few documents as possible (MAX_MUTATIONS_PER_DOC each).
+        After each document, on_applied(set_applied, deleted_ids) reports what actually
+        took effect, so callers can record partial progress. userErrors do not stop the
+        remaining documents; they are collected and raised once everything was sent.
+        Returns the number of metafields deleted.
+        """
+        deleted = 0
+        all_errs: List[dict] = []
+        pending = list(delete_ids)
+        with_set = bool(metafields)
+
+        while with_set or pending:
+            n = min(len(pending), Config.MAX_MUTATIONS_PER_DOC - (1 if with_set else 0))
+            chunk, pending = pending[:n], pending[n:]
+
+            variables: Dict[str, object] = {f"d{i}": mf_id for i, mf_id in enumerate(chunk)}
+            if with_set:
+                variables["set"] = metafields
+
+            data = self.graphql(m_metafield_changes(with_set, n), variables)["data"]
+
+            errs = list(data["s"]["userErrors"]) if with_set else []
+            set_applied = with_set and not errs
+            deleted_ids: List[str] = []
+            for i, mf_id in enumerate(chunk):
+                res = data[f"d{i}"]
+                errs.extend(res["userErrors"])
+                if res.get("deletedId"):
+                    deleted_ids.append(mf_id)
+            deleted += len(deleted_ids)
+
+            if on_applied:
+                on_applied(set_applied, deleted_ids)
+            all_errs.extend(errs)
+
+            with_set = False
+
+        if all_errs:
+            raise RuntimeError(f"metafield changes userErrors: {all_errs}")
+        return deleted
+
+    def get_metafield_ids(self, product_ids: List[str], namespace: str, keys: List[str]) -> Dict[str, Dict[str, Optional[str]]]:
+        """
+        Looks up metafield IDs for many products in one request using GraphQL aliases
+        (p0, p1, ...). Callers should keep product_ids to DELETE_BATCH_SIZE or fewer.
+        Returns {product_id: {key: metafield_id or None}}.
         """
-        idents = [{"namespace": namespace, "key": k} for k in keys]
-        data = self.graphql(q, {"id": product_id, "idents": idents})
-        mfs = data.get("data", {}).get("product", {}).get("metafields", []) or []
-
-        out = {k: None for k in keys}
-        for mf in mfs:
-            if mf and mf.get("key") in out:
-                out[mf["key"]] = mf.get("id")
+        if not product_ids:
+            return {}
+
+        variables: Dict[str, object] = {"idents": [{"namespace": namespace, "key": k} for k in keys]}
+        for i, pid in enumerate(product_ids):
+            variables[f"id{i}"] = pid
+
+        data = self.graphql(q_metafield_ids(len(product_ids)), variables).get("data", {}) or {}
+
+        out: Dict[str, Dict[str, Optional[str]]] = {}
+        for i, pid in enumerate(product_ids):
+            mfs = (data.get(f"p{i}") or {}).get("metafields", []) or []
+            id_map = {k: None for k in keys}
+            for mf in mfs:
+                if mf and mf.get("key") in id_map:
+                    id_map[mf["key"]] = mf.get("id")
+            out[pid] = id_map
         return out
 
-    def metafield_delete(self, metafield_id: str) -> None:
-        m = """
-        mutation($id: ID!) {
-          metafieldDelete(input: {id: $id}) {
-            deletedId
-            userErrors { field message }
-          }
-        }
-        """
-        data = self.graphql(m, {"id": metafield_id})
-        errs = data["data"]["metafieldDelete"]["userErrors"]
-        if errs:
-            raise RuntimeError(f"metafieldDelete userErrors: {errs}")
 
+def plan_template(w: VendorPlan, today: date) -> Tuple[List[Tuple[str, str, str]], List[str]]:
+    """
+    Everything a plan writes/deletes that does not depend on the product:
+    (namespace, key, iso value) tuples to write, and keys to delete.
+    """
+    sale_should_exist = (
+        w.sale_display_start is not None and w.sale_display_end is not None and
+        w.sale_display_start <= today <= w.sale_display_end
+    )
+    pi_should_exist = (
+        w.pi_display_start is not None and w.pi_display_end is not None and
+        w.pi_display_start <= today <= w.pi_display_end
+    )
+
+    base_payload: List[Tuple[str, str, str]] = []
+
+    # WRITE: write REAL dates only
+    if sale_should_exist and w.sale_real_start and w.sale_real_end:
+        base_payload.append((Config.MF_NAMESPACE, Config.MF_SALE_START, w.sale_real_start.isoformat()))
+        base_payload.append((Config.MF_NAMESPACE, Config.MF_SALE_END, w.sale_real_end.isoformat()))
+
+    # PI: if only start exists, still write pi_start
+    if pi_should_exist and w.pi_real_start:
+        base_payload.append((Config.MF_NAMESPACE, Config.MF_PI_START, w.pi_real_start.isoformat()))
+        # Only write PI_END if DB end exists
+        if w.pi_real_end:
+            base_payload.append((Config.MF_NAMESPACE, Config.MF_PI_END, w.pi_real_end.isoformat()))
+
+    keys_to_delete: List[str] = []
+    if not sale_should_exist:
+        keys_to_delete.extend([Config.MF_SALE_START, Config.MF_SALE_END])
+    if not pi_should_exist:
+        keys_to_delete.extend([Config.MF_PI_START, Config.MF_PI_END])
+
+    return base_payload, keys_to_delete
 
-def build_date_metafield(owner_id: str, namespace: str, key: str, d: date) -> dict:
-    return {
-        "ownerId": owner_id,
-        "namespace": namespace,
-        "key": key,
-        "type": "date",
-        "value": d.isoformat(),
-    }
+
+# =========================
+# Local state
+# =========================
+class MetafieldState:
+    """
+    Remembers which of our metafield keys exist on each product, as of the last run.
+    Products missing from the state are unknown and always get the delete lookup.
+    Thread-safe; saved atomically with os.replace.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._keys: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            # Only a cache: an unreadable file means every product gets the delete lookup
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self._keys = {pid: set(keys) for pid, keys in json.load(f).items()}
+            except (OSError, ValueError) as e:
+                print(f"WARNING: ignoring unreadable state file {path}: {e}")
+                self._keys = {}
+
+    def may_have_any(self, product_id: str, keys: List[str]) -> bool:
+        with self._lock:
+            known = self._keys.get(product_id)
+        return known is None or any(k in known for k in keys)
+
+    def mark_written(self, product_id: str, keys: Iterable[str]) -> None:
+        with self._lock:
+            self._keys.setdefault(product_id, set()).update(keys)
+
+    def mark_deleted(self, product_id: str, keys: Iterable[str]) -> None:
+        with self._lock:
+            self._keys.setdefault(product_id, set()).difference_update(keys)
+
+    def mark_checked(self, product_id: str, checked: Iterable[str], present: Iterable[str]) -> None:
+        """`checked` keys were looked up on Shopify; only `present` ones still exist."""
+        with self._lock:
+            known = self._keys.setdefault(product_id, set())
+            known.difference_update(checked)
+            known.update(present)
+
+    def save(self) -> None:
+        with self._lock:
+            data = {pid: sorted(keys) for pid, keys in self._keys.items()}
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+
+
+def flush_product_batch(shop: ShopifyClient, state: MetafieldState,
+                        batch: List[Tuple[str, List[dict], List[str]]]) -> Tuple[int, int]:
+    """
+    Applies one batch of (product_id, metafields to write, keys to delete):
+    one aliased ID lookup for the deletes, then the write and deletes fused into
+    as few mutation documents as possible. Returns (products updated, metafields deleted).
+    """
+    writes = [mf for _, payload, _ in batch for mf in payload]
+    # Skip products the last run left without any of these keys
+    deletes = [(pid, keys) for pid, _, keys in batch if keys and state.may_have_any(pid, keys)]
+    if not writes and not deletes:
+        return 0, 0
+
+    owners = list(dict.fromkeys(mf["ownerId"] for mf in writes))
+    if Config.DRY_RUN:
+        print(f"    DRY_RUN batch: write {len(writes)} metafields for {len(owners)} products, "
+              f"delete lookup for {len(deletes)} products")
+        return 0, 0
+
+    # One aliased lookup for every product needing deletes; query the union of keys
+    all_keys = list(dict.fromkeys(k for _, keys in deletes for k in keys))
+    id_maps: Dict[str, Dict[str, Optional[str]]] = {}
+    if deletes:
+        try:
+            id_maps = shop.get_metafield_ids([pid for pid, _ in deletes], Config.MF_NAMESPACE, all_keys)
+        except Exception as e:
+            print(f"    DELETE ERROR {[pid for pid, _ in deletes]}: {e}")
+            deletes = []
+
+    # Record what the lookup saw first, per product and only for that product's own keys;
+    # writes and deletes applied below then update the state on top of it
+    id_to_key: Dict[str, Tuple[str, str]] = {}
+    for pid, keys in deletes:
+        id_map = id_maps.get(pid, {})
+        state.mark_checked(pid, keys, [k for k in keys if id_map.get(k)])
+        for k in keys:
+            if id_map.get(k):
+                id_to_key[id_map[k]] = (pid, k)
+
+    updated = 0
+    deleted = 0
+
+    def on_applied(set_applied: bool, deleted_ids: List[str]) -> None:
+        nonlocal updated, deleted
+        if set_applied:
+            for mf in writes:
+                state.mark_written(mf["ownerId"], [mf["key"]])
+            updated = len(owners)
+        for mf_id in deleted_ids:
+            pid, k = id_to_key[mf_id]
+            state.mark_deleted(pid, [k])
+        deleted += len(deleted_ids)
+
+    try:
+        shop.apply_metafield_changes(writes, list(id_to_key), on_applied)
+    except Exception as e:
+        print(f"    WRITE/DELETE ERROR {[pid for pid, _, _ in batch]}: {e}")
+
+    return updated, deleted
+
+
+def resolve_vendor_products(w: VendorPlan, shop: ShopifyClient) -> List[str]:
+    """
+    Finds one vendor's products (collection first, product.vendor as fallback).
+    Safe to run from worker threads; log lines are buffered and printed together
+    so vendors do not interleave. A failed listing skips only this vendor.
+    """
+    vendor = w.vendor
+    lines: List[str] = [f"[Vendor] {vendor}"]
+
+    lines.append(f"  Sale display: {w.sale_display_start} -> {w.sale_display_end}")
+    lines.append(f"  Sale REAL:    {w.sale_real_start} -> {w.sale_real_end}")
+    lines.append(f"  PI display:   {w.pi_display_start} -> {w.pi_display_end}")
+    lines.append(f"  PI REAL:      {w.pi_real_start} -> {w.pi_real_end}")
+
+    try:
+        col = shop.find_collection_by_title_exact(vendor)
+        if col:
+            col_id, col_title = col
+            lines.append(f"  Collection matched: {col_title}")
+            product_ids = shop.bulk_list_product_ids_in_collection(col_id)
+        else:
+            lines.append("  Collection not found. Fallback: product.vendor")
+            product_ids = shop.list_product_ids_by_vendor(vendor)
+    except Exception as e:
+        lines.append(f"  LIST ERROR {vendor}: {e}")
+        print("\n".join(lines) + "\n")
+        return []
+
+    lines.append(f"  Products found: {len(product_ids)}")
+    print("\n".join(lines) + "\n")
+    return product_ids
+
+
+def sync_products(by_product: Dict[str, VendorPlan], shop: ShopifyClient, state: MetafieldState,
+                  today: date, ex: ThreadPoolExecutor) -> Tuple[int, int]:
+    """
+    Builds one write/delete per product and dispatches them in batches on `ex`.
+    Returns (products updated, metafields deleted).
+    """
+    # Products are grouped into batches that fit one metafieldsSet and one ID lookup
+    batches: List[List[Tuple[str, List[dict], List[str]]]] = [[]]
+    batch_writes = 0
+
+    # Most products share their vendor's plan object, so build each template once
+    templates: Dict[int, Tuple[List[Tuple[str, str, str]], List[str]]] = {}
+
+    for pid, w in by_product.items():
+        template = templates.get(id(w))
+        if template is None:
+            template = templates[id(w)] = plan_template(w, today)
+        base_payload, keys_to_delete = template
+
+        payload = [
+            {"ownerId": pid, "namespace": ns, "key": k, "type": "date", "value": v}
+            for ns, k, v in base_payload
+        ]
+
+        if Config.DRY_RUN:
+            if payload:
+                print(f"    DRY_RUN WRITE {pid}: {[(x['namespace'] + '.' + x['key'], x['value']) for x in payload]}")
+            if keys_to_delete:
+                print(f"    DRY_RUN DELETE {pid}: {[(Config.MF_NAMESPACE + '.' + k) for k in keys_to_delete]}")
+
+        if not payload and not keys_to_delete:
+            continue
+
+        if (batch_writes + len(payload) > Config.METAFIELDS_PER_CALL or
+                len(batches[-1]) >= Config.DELETE_BATCH_SIZE):
+            batches.append([])
+            batch_writes = 0
+        batches[-1].append((pid, payload, keys_to_delete))
+        batch_writes += len(payload)
+
+    updated = deleted = 0
+    for u, d in ex.map(lambda b: flush_product_batch(shop, state, b), batches):
+        updated += u
+        deleted += d
+    return updated, deleted
 
 
 # =========================
@@ -481,15 +1053,16 @@ def main():
     db = DatabaseConnection()
     try:
         reader = RetailPromotionsReader(db)
+        # Rows are streamed from the cursor straight into the per-vendor plans
         rows = reader.fetch_active_today(Config.SALE_PRE_DAYS, Config.PI_PRE_DAYS, Config.PI_POST_DAYS)
+        vendor_plans = build_vendor_plans(rows)
     finally:
         db.close()
 
-    if not rows:
+    if not vendor_plans:
         print("No active retail promotions today. Nothing to write.")
         return
 
-    vendor_plans = aggregate_by_vendor(rows, Config.SALE_PRE_DAYS, Config.PI_PRE_DAYS, Config.PI_POST_DAYS)
     print(f"Vendors to process: {len(vendor_plans)}")
     print("")
 
@@ -504,102 +1077,41 @@ def main():
         return
 
     shop = ShopifyClient()
+    state = MetafieldState(Config.STATE_FILE)
 
-    collection_cache: Dict[str, Optional[Tuple[str, str]]] = {}
-    product_cache: Dict[str, List[str]] = {}
-
-    updated_products = 0
-    deleted_metafields = 0
-
-    for w in vendor_plans:
-        vendor = w.vendor
-        print(f"[Vendor] {vendor}")
+    # Title lookups are cheap; resolve every vendor's collection up front in parallel so
+    # the product listing below starts from ShopifyClient's warm collection cache
+    vendors = [w.vendor for w in vendor_plans]
 
-        print(f"  Sale display: {w.sale_display_start} -> {w.sale_display_end}")
-        print(f"  Sale REAL:    {w.sale_real_start} -> {w.sale_real_end}")
-        print(f"  PI display:   {w.pi_display_start} -> {w.pi_display_end}")
-        print(f"  PI REAL:      {w.pi_real_start} -> {w.pi_real_end}")
-
-        sale_should_exist = (
-            w.sale_display_start is not None and w.sale_display_end is not None and
-            w.sale_display_start <= today <= w.sale_display_end
-        )
-        pi_should_exist = (
-            w.pi_display_start is not None and w.pi_display_end is not None and
-            w.pi_display_start <= today <= w.pi_display_end
-        )
-
-        if vendor in collection_cache:
-            col = collection_cache[vendor]
-        else:
-            col = shop.find_collection_by_title_exact(vendor)
-            collection_cache[vendor] = col
+    def prefetch_collection(vendor: str) -> Optional[Tuple[str, str]]:
+        # Failures are not cached; resolve_vendor_products retries and reports them
+        try:
+            return shop.find_collection_by_title_exact(vendor)
+        except Exception:
+            return None
 
-        cache_key = f"{vendor}::{'collection' if col else 'vendor'}"
+    with ThreadPoolExecutor(max_workers=Config.COLLECTION_WORKERS) as ex:
+        cols = dict(zip(vendors, ex.map(prefetch_collection, vendors)))
+    print(f"Collections matched: {sum(1 for c in cols.values() if c)}/{len(cols)}")
+    print("")
 
-        if cache_key in product_cache:
-            product_ids = product_cache[cache_key]
-        else:
-            if col:
-                col_id, col_title = col
-                print(f"  Collection matched: {col_title}")
-                product_ids = shop.list_product_ids_in_collection(col_id)
-            else:
-                print("  Collection not found. Fallback: product.vendor")
-                product_ids = shop.list_product_ids_by_vendor(vendor)
-
-            product_cache[cache_key] = product_ids
-
-        print(f"  Products found: {len(product_ids)}")
-
-        for pid in product_ids:
-            payload: List[dict] = []
-
-            # WRITE: write REAL dates only
-            if sale_should_exist and w.sale_real_start and w.sale_real_end:
-                payload.append(build_date_metafield(pid, Config.MF_NAMESPACE, Config.MF_SALE_START, w.sale_real_start))
-                payload.append(build_date_metafield(pid, Config.MF_NAMESPACE, Config.MF_SALE_END, w.sale_real_end))
-
-            # PI: if only start exists, still write pi_start
-            if pi_should_exist and w.pi_real_start:
-                payload.append(build_date_metafield(pid, Config.MF_NAMESPACE, Config.MF_PI_START, w.pi_real_start))
-                # Only write PI_END if DB end exists
-                if w.pi_real_end:
-                    payload.append(build_date_metafield(pid, Config.MF_NAMESPACE, Config.MF_PI_END, w.pi_real_end))
-
-            keys_to_delete: List[str] = []
-            if not sale_should_exist:
-                keys_to_delete.extend([Config.MF_SALE_START, Config.MF_SALE_END])
-            if not pi_should_exist:
-                keys_to_delete.extend([Config.MF_PI_START, Config.MF_PI_END])
-
-            if Config.DRY_RUN:
-                if payload:
-                    print(f"    DRY_RUN WRITE {pid}: {[(x['namespace'] + '.' + x['key'], x['value']) for x in payload]}")
-                if keys_to_delete:
-                    print(f"    DRY_RUN DELETE {pid}: {[(Config.MF_NAMESPACE + '.' + k) for k in keys_to_delete]}")
-            else:
-                if payload:
-                    try:
-                        shop.metafields_set(payload)
-                        updated_products += 1
-                    except Exception as e:
-                        print(f"    WRITE ERROR {pid}: {e}")
-
-                if keys_to_delete:
-                    try:
-                        id_map = shop.get_metafield_ids(pid, Config.MF_NAMESPACE, keys_to_delete)
-                        for k in keys_to_delete:
-                            mf_id = id_map.get(k)
-                            if mf_id:
-                                shop.metafield_delete(mf_id)
-                                deleted_metafields += 1
-                    except Exception as e:
-                        print(f"    DELETE ERROR {pid}: {e}")
-
-            time.sleep(Config.SLEEP_BETWEEN_CALLS)
-
-        print("")
+    # Vendors are independent; resolve them concurrently. ShopifyClient throttles all
+    # threads against Shopify's per-shop cost bucket.
+    try:
+        with ThreadPoolExecutor(max_workers=Config.VENDOR_WORKERS) as ex:
+            # One entry per product: a product listed under several vendors gets their
+            # plans merged and is written/deleted only once
+            by_product: Dict[str, VendorPlan] = {}
+            for w, product_ids in zip(vendor_plans, ex.map(lambda w: resolve_vendor_products(w, shop), vendor_plans)):
+                for pid in product_ids:
+                    prev = by_product.get(pid)
+                    by_product[pid] = w if prev is None else merge_plans(prev, w)
+
+            print(f"Unique products: {len(by_product)}")
+            updated_products, deleted_metafields = sync_products(by_product, shop, state, today, ex)
+    finally:
+        if not Config.DRY_RUN:
+            state.save()
 
     print("=== Done ===")
     if Config.DRY_RUN: